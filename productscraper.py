@@ -1,5 +1,4 @@
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
 """Products Scraper.
 
 Usage:
@@ -11,20 +10,75 @@ Options:
 
 import os
 import re
+import ssl
 import sys
 import json
-from urlparse import urljoin
-
-import requests
-from bs4 import BeautifulSoup
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import TracebackType
+from urllib.parse import urljoin
+
+import httpx
+import lxml.html
+from cachetools import LRUCache
 from docopt import docopt
+from lxml import etree
+from lxml.html import html5parser
+from selectolax.lexbor import LexborHTMLParser
+
+
+XML_DECLARATION_REGEX = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+
+def _lxml_fromstring(page_content: str) -> etree._Element:
+    ''' lxml refuses decoded text with encoding declaration (XHTML pages)
+    and documents without any elements, those are parsed as empty page.
+    '''
+    page_content = XML_DECLARATION_REGEX.sub('', page_content, count=1)
+    try:
+        return lxml.html.document_fromstring(page_content)
+    except etree.ParserError:
+        return lxml.html.Element('html')
+
+
+def _html5lib_fromstring(page_content: str) -> etree._Element:
+    ''' html5lib parser keeps state, so new one is needed for every page '''
+    parser = html5parser.HTMLParser(namespaceHTMLElements=False)
+    return html5parser.document_fromstring(page_content, parser=parser)
+
+
+PARSERS = {
+    'lxml': _lxml_fromstring,
+    'html5lib': _html5lib_fromstring,
+}
+
+
+@lru_cache(maxsize=1024)
+def _resolve(base_url: str, url: str) -> str:
+    ''' urljoin parses both URLs every time, the same pairs come up a lot '''
+    return urljoin(base_url, url)
+
+
+@lru_cache(maxsize=None)
+def _ssl_context() -> ssl.SSLContext:
+    ''' Loading CA certificates is the slowest part of creating a client,
+    every scraper can share the same context
+    '''
+    return httpx.create_ssl_context()
+
+
+def _has_class(class_name: str) -> str:
+    ''' XPath condition matching elements with given CSS class '''
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(class_name)
 
 
 class MainPageException(Exception):
     pass
 
 
-class ProductScraper(object):
+class ProductScraper:
     '''
     ProductsScaper provides a way of extracting inforation about products form given URL
     Base url has to point to a page with list of products.
@@ -32,9 +86,9 @@ class ProductScraper(object):
     Usage:
 
     >>> from productscraper import ProductScraper
-    >>> scraper = ProductScraper('http://somewhere.com/fruits/')
-    >>> product_data = scraper.scrape()
-    >>> print product_data
+    >>> with ProductScraper('http://somewhere.com/fruits/') as scraper:
+    ...     product_data = scraper.scrape()
+    >>> print(product_data)
     {
         'results': [{
             'title': 'Fruit A',
@@ -62,11 +116,68 @@ class ProductScraper(object):
     '''
 
     NUMBER_REGEX = re.compile(r'\d*\.\d+|\d+')
-
-    def __init__(self, start_url):
+    MAX_WORKERS = 8
+    TIMEOUT = 30.0
+    DETAILS_CACHE_SIZE = 256
+
+    _PRODUCTS_XP = etree.XPath('(//ul[{}])[1]/li'.format(_has_class('productLister')))
+    _TITLE_XP = etree.XPath('(.//h3)[1]')
+    _LINK_XP = etree.XPath('(.//a)[1]/@href', smart_strings=False)
+    _PRICE_XP = etree.XPath('string((.//*[{}])[1])'.format(_has_class('pricePerUnit')))
+    _TEXT_XP = etree.XPath('string()')
+
+    def __init__(
+        self,
+        start_url: str,
+        parser: str = 'lxml',
+        max_workers: int = MAX_WORKERS,
+        timeout: float | None = TIMEOUT,
+    ) -> None:
+        ''' `parser` is one of PARSERS used for main page, lxml is the fastest one.
+        'html5lib' is still supported for pages lxml can not cope with.
+        `max_workers` limits number of details pages fetched at once.
+        `timeout` (seconds, None to wait forever) applies to every network
+        operation. Details page that times out is left without description
+        and size, timeout on main page is raised.
+        '''
         self._start_url = start_url
-
-    def scrape(self):
+        self._parser = PARSERS[parser]
+        self._max_workers = max_workers
+
+        # Single client keeps connections to the shop alive between requests.
+        # Over HTTP/2 all workers share one connection, pool is only
+        # needed for servers that speak HTTP/1.1.
+        self._client = httpx.Client(
+            http2=True,
+            verify=_ssl_context(),
+            follow_redirects=True,
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_workers,
+                max_keepalive_connections=max_workers,
+            ),
+        )
+
+        # Details of products already seen, by absolute URL of details page
+        self._details_cache = LRUCache(maxsize=self.DETAILS_CACHE_SIZE)
+        self._details_cache_lock = threading.Lock()
+
+    def __enter__(self) -> 'ProductScraper':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        ''' Closes all connections kept open by scraper '''
+        self._client.close()
+
+    def scrape(self) -> dict:
         ''' Scrapes product web page.
         Returns a dict with info about products and total cost (1 of each)
 
@@ -87,13 +198,38 @@ class ProductScraper(object):
             # there is no point going furhter (emtpy page, http error, ...)
             raise MainPageException("Could not fetch body of main page")
 
-        main_page = self._parse(main_page_content)
+        main_page = self._parse_main(main_page_content)
+        del main_page_content
+
+        products = [
+            self._product_info(product)
+            for product in self._products(main_page)
+        ]
+        # Only extracted data is needed from now on, free the tree
+        # before details pages start coming in
+        del main_page
+
+        total = sum((unit_price for _, _, unit_price in products), 0.0)
+
+        # Details pages are independent, so fetch them in parallel.
+        # Products linking to the same page share a single request.
+        # Threads are enough here: at most max_workers requests are in
+        # flight and over HTTP/2 they are multiplexed on one connection,
+        # an event loop would not fetch them any faster.
+        details_urls = [
+            _resolve(self._start_url, details_url) if details_url else None
+            for _, details_url, _ in products
+        ]
+        unique_urls = list(OrderedDict.fromkeys(url for url in details_urls if url))
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            details: dict[str | None, dict] = dict(zip(
+                unique_urls,
+                executor.map(self._product_details, unique_urls),
+            ))
 
         results = []
-        total = 0.0
-        for product in self._products(main_page):
-            product_data = self._product_info(product)
-            total += product_data.get('unit_price', 0.0)
+        for (product_data, _, _), details_url in zip(products, details_urls):
+            product_data.update(details.get(details_url, {}))
             results.append(product_data)
 
         product_data = {
@@ -103,19 +239,20 @@ class ProductScraper(object):
 
         return product_data
 
-    def _get(self, url):
-        ''' Wraper around requests maily to handle relative URLs '''
+    def _get(self, url: str) -> str | None:
+        ''' Wraper around httpx maily to handle relative URLs.
+        Pages without declared charset are decoded as utf-8.
+        '''
 
-        url = urljoin(self._start_url, url)
-        response = requests.get(url)
-        if response.ok:
-            return response.text
-        else:
+        url = _resolve(self._start_url, url)
+        response = self._client.get(url)
+        if response.is_error:
             return None
 
-    @staticmethod
-    def _products(page):
-        ''' Wraper around requests maily to handle relative URLs
+        return response.text
+
+    def _products(self, page: etree._Element) -> list[etree._Element]:
+        ''' Returns list of product elements (empty if list is missing)
 
         Expected html structure:
         <ul class="productLister">
@@ -125,19 +262,14 @@ class ProductScraper(object):
         </ul>
         '''
 
-        product_list_el = page.body.find('ul', class_='productLister')
-        if not product_list_el:
-            return []
-
-        products = product_list_el.find_all('li', recursive=False)
-        return products
+        return self._PRODUCTS_XP(page)
 
-    def _product_info(self, product):
+    def _product_info(self, product: etree._Element) -> tuple[dict, str | None, float]:
         ''' Extracts available info from product listed on base page.
+        Returns tuple of dict, URL of details page (None if missing)
+        and unit price (0.0 if missing).
         Returned dict will contain as much info as it was possible to gather:
         - title
-        - description (separate request to detail page)
-        - size of details page in kb
         - unit price
 
         Expected html structure:
@@ -148,28 +280,73 @@ class ProductScraper(object):
             <tag class="pricePerUnit">£1.8/unit</tag>
         </li>
         '''
-        info = {}
-        info.update(self._product_title_section(product))
-        info.update(self._product_price_section(product))
+        info, details_url = self._product_title_section(product)
+        price_info, unit_price = self._product_price_section(product)
+        info.update(price_info)
 
-        return info
+        return info, details_url, unit_price
+
+    def _parse_main(self, page_content: str) -> etree._Element:
+        ''' Pases main page in consistent way '''
+        return self._parser(page_content)
 
     @staticmethod
-    def _parse(page_content):
-        ''' Pases content in consistent way '''
-        return BeautifulSoup(page_content, 'html5lib')
+    def _parse_detail(page_content: str) -> str | None:
+        ''' Returns description from details page (None if missing).
+        Only one element is needed, so selectolax is used instead of building lxml tree.
+        '''
+        description_el = LexborHTMLParser(page_content).css_first('.productText')
+        if description_el is None:
+            return None
 
-    def _product_title_section(self, product):
+        return description_el.text().strip()
+
+    def _product_title_section(self, product: etree._Element) -> tuple[dict, str | None]:
         ''' Parses title section of product on the list.
-        Returns dict with all info it could get:
-        - title
-        - description (separate request to detail page)
-        - size of details page in kb
+        Returns tuple of dict with title (if present)
+        and URL of details page (None if missing).
 
         Expected html structure of title section:
         <h3>
             <a href="URL">Title</a>
         </h3>
+        '''
+
+        info: dict = {}
+
+        title_els = self._TITLE_XP(product)
+        if not title_els:
+            return info, None
+        info['title'] = self._TEXT_XP(title_els[0]).strip()
+
+        links = self._LINK_XP(title_els[0])
+        if not links or not links[0]:
+            return info, None
+
+        return info, links[0]
+
+    def _product_details(self, details_url: str) -> dict:
+        ''' Cached version of _fetch_product_details.
+        Failed fetches are not cached, so they are retried next time.
+        '''
+
+        with self._details_cache_lock:
+            info = self._details_cache.get(details_url)
+        if info is not None:
+            return info
+
+        info = self._fetch_product_details(details_url)
+        if info:
+            with self._details_cache_lock:
+                self._details_cache[details_url] = info
+
+        return info
+
+    def _fetch_product_details(self, details_url: str | None) -> dict:
+        ''' Fetches details page of product.
+        Returns dict with all info it could get:
+        - description
+        - size of details page in kb
 
         Expected html structure of details page:
         <p class="productText">
@@ -177,34 +354,31 @@ class ProductScraper(object):
         </p>
         '''
 
-        info = {}
-
-        title_el = product.find('h3')
-        if not title_el:
+        info: dict = {}
+        if not details_url:
             return info
-        info['title'] = title_el.text.strip()
 
-        link_el = title_el.find('a')
-        if not link_el or not link_el.attrs.get('href'):
+        try:
+            details_page_content = self._get(details_url)
+        except httpx.TimeoutException:
+            # One slow page should not lose products fetched already
             return info
-
-        details_url = link_el.attrs.get('href')
-        details_page_content = self._get(details_url)
         if not details_page_content:
             return info
 
-        details_page = self._parse(details_page_content)
-        description = details_page.find(class_='productText').text
-        info['description'] = description.strip()
-
         page_size = len(details_page_content)
-        info['size'] = '{:.2f}kb'.format(page_size/1000.0)
+        info['size'] = f'{page_size / 1000:.2f}kb'
+
+        description = self._parse_detail(details_page_content)
+        if description is not None:
+            info['description'] = description
 
         return info
 
-    def _product_price_section(self, product):
+    def _product_price_section(self, product: etree._Element) -> tuple[dict, float]:
         ''' Parses price section of product on the list.
-        Returns dict with unit price if present.
+        Returns tuple of dict with unit price if present
+        and the price itself (0.0 if missing or invalid).
 
         Expected html structure of title section:
         <tag class="pricePerUnit">
@@ -212,26 +386,29 @@ class ProductScraper(object):
         </tag>
         '''
 
-        info = {}
-        unit_price_el = product.find(class_='pricePerUnit')
-        if not unit_price_el:
-            return info
+        info: dict = {}
+        unit_price_text = self._PRICE_XP(product)
+        if not unit_price_text:
+            return info, 0.0
 
-        match = re.search(self.NUMBER_REGEX, unit_price_el.text)
-        if match:
-            info['unit_price'] = float(match.group())
+        match = self.NUMBER_REGEX.search(unit_price_text)
+        if not match:
+            return info, 0.0
 
-        return info
+        unit_price = float(match.group())
+        info['unit_price'] = unit_price
+
+        return info, unit_price
 
 
-def main(start_url):
-    scraper = ProductScraper(start_url=start_url)
+def main(start_url: str) -> dict | str:
     try:
-        return scraper.scrape()
-    except requests.exceptions.ConnectionError, e:
+        with ProductScraper(start_url=start_url) as scraper:
+            return scraper.scrape()
+    except httpx.ConnectError as e:
         return 'Could not connect to {}'.format(e.request.url)
-    except (MainPageException, requests.exceptions.RequestException), e:
-        return e.message
+    except (MainPageException, httpx.HTTPError, httpx.InvalidURL) as e:
+        return str(e)
 
 
 if __name__ == '__main__':
@@ -241,8 +418,8 @@ if __name__ == '__main__':
     data = main(start_url)
 
     if isinstance(data, dict):
-        print json.dumps(data, indent=4)
+        print(json.dumps(data, indent=4))
         sys.exit(os.EX_OK)
 
-    print data
+    print(data)
     sys.exit(1)
@@ -1,9 +1,8 @@
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
-from __future__ import unicode_literals
+#!/usr/bin/env python3
 import unittest
 
-import requests_mock
+import httpx
+import respx
 
 from productscraper import (
     main,
@@ -24,6 +23,11 @@ class BaseProductScraperTestCase(unittest.TestCase):
     )
     product_details_tpl = '<p class="productText">{}</p>'
 
+    def setUp(self):
+        self.http_mock = respx.mock(assert_all_called=False)
+        self.http_mock.start()
+        self.addCleanup(self.http_mock.stop)
+
     def _build_main_page(self, products_info, product_tpl=None):
         product_tpl = product_tpl or self.product_tpl
 
@@ -39,49 +43,80 @@ class BaseProductScraperTestCase(unittest.TestCase):
         product_details_tpl = product_details_tpl or self.product_details_tpl
         product_details = product_details_tpl.format(description)
         page = self.page_tpl.format(product_details)
-        size = '{:.2f}kb'.format(len(page)/1000.0)
+        size = f'{len(page) / 1000:.2f}kb'
         return page, size
 
 
-@requests_mock.Mocker()
 class ProductListTestCase(BaseProductScraperTestCase):
 
-    def test_empty_product_list(self, req_mock):
+    def test_empty_product_list(self):
         main_page = self.page_tpl.format('some content')
-        req_mock.get('http://something.com/fruits/', text=main_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(product_data, {'results': [], 'total': 0.0})
 
-    def test_problems_with_main_page(self, req_mock):
-        req_mock.get('http://something.com/500/', status_code=500)
-
-        scraper = ProductScraper('http://something.com/500/')
+    def test_problems_with_main_page(self):
+        self.http_mock.get('http://something.com/500/').respond(500)
 
-        with self.assertRaises(MainPageException):
-            scraper.scrape()
+        with ProductScraper('http://something.com/500/') as scraper:
+            with self.assertRaises(MainPageException):
+                scraper.scrape()
 
-    def test_product_list_missing(self, req_mock):
+    def test_product_list_missing(self):
         main_page = self._build_main_page([])
-        req_mock.get('http://something.com/fruits/', text=main_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(product_data, {'results': [], 'total': 0.0})
 
-    def test_one_product_on_list(self, req_mock):
+    def test_main_page_without_elements(self):
+        for main_page in ['  \n ', '<!-- nothing here -->']:
+            self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+
+            with ProductScraper('http://something.com/fruits/') as scraper:
+                product_data = scraper.scrape()
+
+            self.assertEqual(product_data, {'results': [], 'total': 0.0})
+
+    def test_main_page_with_xml_declaration(self):
+        main_page = '<?xml version="1.0" encoding="utf-8"?>\n' + self._build_main_page([
+            ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
+        ])
+        product_page, product_page_size = self._build_product_page('Tasty')
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
+
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
+
+        self.assertEqual(
+            product_data,
+            {
+                'results': [{
+                    'title': 'Fruit A',
+                    'description': 'Tasty',
+                    'unit_price': 1.8,
+                    'size': product_page_size,
+                }],
+                'total': 1.8,
+            },
+        )
+
+    def test_one_product_on_list(self):
         main_page = self._build_main_page([
             ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
         ])
         product_page, product_page_size = self._build_product_page('Tasty')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/A/', text=product_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -96,7 +131,7 @@ class ProductListTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_multiple_products_on_list(self, req_mock):
+    def test_multiple_products_on_list(self):
         main_page = self._build_main_page([
             ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
             ('http://something.com/fruits/B/', 'Fruit B', '£2.5'),
@@ -105,13 +140,13 @@ class ProductListTestCase(BaseProductScraperTestCase):
         product_page_a, product_page_size_a = self._build_product_page('Tasty')
         product_page_b, product_page_size_b = self._build_product_page('Super Fruit')
         product_page_c, product_page_size_c = self._build_product_page('Green')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/A/', text=product_page_a)
-        req_mock.get('http://something.com/fruits/B/', text=product_page_b)
-        req_mock.get('http://something.com/fruits/C/', text=product_page_c)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page_a)
+        self.http_mock.get('http://something.com/fruits/B/').respond(text=product_page_b)
+        self.http_mock.get('http://something.com/fruits/C/').respond(text=product_page_c)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -140,19 +175,204 @@ class ProductListTestCase(BaseProductScraperTestCase):
             }
         )
 
+    def test_same_details_page_fetched_once(self):
+        main_page = self._build_main_page([
+            ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
+            ('/fruits/A/', 'Fruit A (big)', '£2.5'),
+        ])
+        product_page, product_page_size = self._build_product_page('Tasty')
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        details_route = self.http_mock.get('http://something.com/fruits/A/').respond(
+            text=product_page,
+        )
+
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
+            scraper.scrape()
+
+        self.assertEqual(
+            product_data,
+            {
+                'results': [
+                    {
+                        'title': 'Fruit A',
+                        'description': 'Tasty',
+                        'unit_price': 1.8,
+                        'size': product_page_size,
+                    },
+                    {
+                        'title': 'Fruit A (big)',
+                        'description': 'Tasty',
+                        'unit_price': 2.5,
+                        'size': product_page_size,
+                    },
+                ],
+                'total': 4.3,
+            }
+        )
+        self.assertEqual(details_route.call_count, 1)
+
+    def test_details_page_timeout(self):
+        main_page = self._build_main_page([
+            ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
+            ('http://something.com/fruits/B/', 'Fruit B', '£2.5'),
+        ])
+        product_page, product_page_size = self._build_product_page('Tasty')
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').mock(
+            side_effect=httpx.ReadTimeout('Timed out'),
+        )
+        self.http_mock.get('http://something.com/fruits/B/').respond(text=product_page)
+
+        with ProductScraper('http://something.com/fruits/', timeout=1.0) as scraper:
+            product_data = scraper.scrape()
+
+        self.assertEqual(
+            product_data,
+            {
+                'results': [
+                    {
+                        'title': 'Fruit A',
+                        'unit_price': 1.8,
+                    },
+                    {
+                        'title': 'Fruit B',
+                        'description': 'Tasty',
+                        'unit_price': 2.5,
+                        'size': product_page_size,
+                    },
+                ],
+                'total': 4.3,
+            }
+        )
+
+    def test_main_page_timeout(self):
+        self.http_mock.get('http://something.com/fruits/').mock(
+            side_effect=httpx.ReadTimeout('Timed out'),
+        )
+
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            with self.assertRaises(httpx.ReadTimeout):
+                scraper.scrape()
+
+    def test_failed_details_page_fetched_again(self):
+        main_page = self._build_main_page([
+            ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
+        ])
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        details_route = self.http_mock.get('http://something.com/fruits/A/').respond(500)
+
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            scraper.scrape()
+            scraper.scrape()
+
+        self.assertEqual(details_route.call_count, 2)
+
+    def test_client_closed_on_exit(self):
+        main_page = self._build_main_page([])
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            scraper.scrape()
+            self.assertFalse(scraper._client.is_closed)
+
+        self.assertTrue(scraper._client.is_closed)
+
+    def test_single_worker(self):
+        main_page = self._build_main_page([
+            ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
+            ('http://something.com/fruits/B/', 'Fruit B', '£2.5'),
+        ])
+        product_page_a, product_page_size_a = self._build_product_page('Tasty')
+        product_page_b, product_page_size_b = self._build_product_page('Green')
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page_a)
+        self.http_mock.get('http://something.com/fruits/B/').respond(text=product_page_b)
+
+        with ProductScraper('http://something.com/fruits/', max_workers=1) as scraper:
+            product_data = scraper.scrape()
+
+        self.assertEqual(
+            product_data,
+            {
+                'results': [
+                    {
+                        'title': 'Fruit A',
+                        'description': 'Tasty',
+                        'unit_price': 1.8,
+                        'size': product_page_size_a,
+                    },
+                    {
+                        'title': 'Fruit B',
+                        'description': 'Green',
+                        'unit_price': 2.5,
+                        'size': product_page_size_b,
+                    },
+                ],
+                'total': 4.3,
+            }
+        )
+
+    def test_undeclared_charset(self):
+        main_page = self._build_main_page([
+            ('http://something.com/fruits/A/', 'Jabłko', '£1.8/unit'),
+        ])
+        product_page, product_page_size = self._build_product_page('Słodkie')
+        self.http_mock.get('http://something.com/fruits/').respond(content=main_page.encode('utf-8'))
+        self.http_mock.get('http://something.com/fruits/A/').respond(content=product_page.encode('utf-8'))
+
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
+
+        self.assertEqual(
+            product_data,
+            {
+                'results': [{
+                    'title': 'Jabłko',
+                    'description': 'Słodkie',
+                    'unit_price': 1.8,
+                    'size': product_page_size,
+                }],
+                'total': 1.8,
+            },
+        )
+
+    def test_html5lib_parser(self):
+        main_page = self._build_main_page([
+            ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
+        ])
+        product_page, product_page_size = self._build_product_page('Tasty')
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
+
+        with ProductScraper('http://something.com/fruits/', parser='html5lib') as scraper:
+            product_data = scraper.scrape()
+
+        self.assertEqual(
+            product_data,
+            {
+                'results': [{
+                    'title': 'Fruit A',
+                    'description': 'Tasty',
+                    'unit_price': 1.8,
+                    'size': product_page_size,
+                }],
+                'total': 1.8,
+            },
+        )
+
 
-@requests_mock.Mocker()
 class ProductTestCase(BaseProductScraperTestCase):
-    def test_product_price_missing(self, req_mock):
+    def test_product_price_missing(self):
         main_page = self._build_main_page([
             ('http://something.com/fruits/A/', 'Fruit A', ''),
         ])
         product_page, product_page_size = self._build_product_page('Tasty')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/A/', text=product_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -167,16 +387,16 @@ class ProductTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_product_price_invalid(self, req_mock):
+    def test_product_price_invalid(self):
         main_page = self._build_main_page([
             ('http://something.com/fruits/A/', 'Fruit A', '£blah/unit'),
         ])
         product_page, product_page_size = self._build_product_page('Tasty')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/A/', text=product_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -191,18 +411,18 @@ class ProductTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_product_price_section_missing(self, req_mock):
+    def test_product_price_section_missing(self):
         product_tpl = '<li><h3><a href="{}">{}</a></h3></li>'
         main_page = self._build_main_page(
             [('http://something.com/fruits/A/', 'Fruit A')],
             product_tpl=product_tpl,
         )
         product_page, product_page_size = self._build_product_page('Tasty')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/A/', text=product_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -216,16 +436,16 @@ class ProductTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_product_title_empty(self, req_mock):
+    def test_product_title_empty(self):
         main_page = self._build_main_page([
             ('http://something.com/fruits/A/', '', 1.2),
         ])
         product_page, product_page_size = self._build_product_page('Tasty')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/A/', text=product_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -240,13 +460,13 @@ class ProductTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_product_title_section_missing(self, req_mock):
+    def test_product_title_section_missing(self):
         product_tpl = '<li><p class="pricePerUnit">{}</p></li>'
         main_page = self._build_main_page([(1.2,)], product_tpl=product_tpl)
-        req_mock.get('http://something.com/fruits/', text=main_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -258,15 +478,40 @@ class ProductTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_product_link_to_details_missing(self, req_mock):
+    def test_product_description_missing(self):
+        main_page = self._build_main_page([
+            ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
+        ])
+        product_page, product_page_size = self._build_product_page(
+            'Tasty', product_details_tpl='<p>{}</p>',
+        )
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
+
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
+
+        self.assertEqual(
+            product_data,
+            {
+                'results': [{
+                    'title': 'Fruit A',
+                    'unit_price': 1.8,
+                    'size': product_page_size,
+                }],
+                'total': 1.8,
+            },
+        )
+
+    def test_product_link_to_details_missing(self):
         product_tpl = '<li><h3>{}</h3><p class="pricePerUnit">{}</p></li>'
         main_page = self._build_main_page(
             [('Fruit A', 1.2)], product_tpl=product_tpl,
         )
-        req_mock.get('http://something.com/fruits/', text=main_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -279,16 +524,16 @@ class ProductTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_product_link_without_host(self, req_mock):
+    def test_product_link_without_host(self):
         main_page = self._build_main_page([
             ('/fruits/A/', 'Fruit A', '£1.8/unit'),
         ])
         product_page, product_page_size = self._build_product_page('Tasty')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/A/', text=product_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -303,7 +548,7 @@ class ProductTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_product_link_without_href(self, req_mock):
+    def test_product_link_without_href(self):
         product_tpl = (
             '<li>'
             '   <h3><a>{}</a></h3>'
@@ -314,10 +559,10 @@ class ProductTestCase(BaseProductScraperTestCase):
         main_page = self._build_main_page(
             [('Fruit A', '£1.8/unit')], product_tpl=product_tpl,
         )
-        req_mock.get('http://something.com/fruits/', text=main_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -330,20 +575,20 @@ class ProductTestCase(BaseProductScraperTestCase):
             },
         )
 
-    def test_product_different_responses(self, req_mock):
+    def test_product_different_responses(self):
         main_page = self._build_main_page([
             ('/fruits/200/', 'Fruit A', '£1.8/unit'),
             ('/fruits/404/', 'Fruit B', '£1/unit'),
             ('/fruits/500/', 'Fruit C', '£1/unit'),
         ])
         product_page, product_page_size = self._build_product_page('Tasty')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/200/', text=product_page, status_code=200)
-        req_mock.get('http://something.com/fruits/404/', text='Not Found', status_code=404)
-        req_mock.get('http://something.com/fruits/500/', text='Not Found', status_code=404)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/200/').respond(200, text=product_page)
+        self.http_mock.get('http://something.com/fruits/404/').respond(404, text='Not Found')
+        self.http_mock.get('http://something.com/fruits/500/').respond(404, text='Not Found')
 
-        scraper = ProductScraper('http://something.com/fruits/')
-        product_data = scraper.scrape()
+        with ProductScraper('http://something.com/fruits/') as scraper:
+            product_data = scraper.scrape()
 
         self.assertEqual(
             product_data,
@@ -370,14 +615,13 @@ class ProductTestCase(BaseProductScraperTestCase):
 
 
 class MainTestCase(BaseProductScraperTestCase):
-    @requests_mock.Mocker()
-    def test_main(self, req_mock):
+    def test_main(self):
         main_page = self._build_main_page([
             ('http://something.com/fruits/A/', 'Fruit A', '£1.8/unit'),
         ])
         product_page, product_page_size = self._build_product_page('Tasty')
-        req_mock.get('http://something.com/fruits/', text=main_page)
-        req_mock.get('http://something.com/fruits/A/', text=product_page)
+        self.http_mock.get('http://something.com/fruits/').respond(text=main_page)
+        self.http_mock.get('http://something.com/fruits/A/').respond(text=product_page)
 
         product_data = main('http://something.com/fruits/')
 
@@ -395,15 +639,17 @@ class MainTestCase(BaseProductScraperTestCase):
         )
 
     def test_invalid_base_url(self):
+        # URL is rejected by real transport, which is replaced by mock
+        self.http_mock.stop()
+
         scraped = main('invalid.com')
         self.assertEqual(
             scraped,
-            "Invalid URL 'invalid.com': No schema supplied. Perhaps you meant http://invalid.com?",
+            "Request URL is missing an 'http://' or 'https://' protocol.",
         )
 
-    @requests_mock.Mocker()
-    def test_problems_with_main_page(self, req_mock):
-        req_mock.get('http://something.com/500/', status_code=500)
+    def test_problems_with_main_page(self):
+        self.http_mock.get('http://something.com/500/').respond(500)
 
         scraped = main('http://something.com/500/')
 